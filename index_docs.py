@@ -5,15 +5,26 @@ Questo script legge tutti i file PDF e TXT dalla cartella data/,
 li processa in chunk, crea gli embedding e li carica nel database vettoriale Pinecone.
 """
 
+import argparse
+import asyncio
+import hashlib
+import json
 import os
+import sqlite3
 import sys
+from array import array
+from collections import deque
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from itertools import islice
 from pathlib import Path
-from typing import List, Tuple
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+import tiktoken
 from dotenv import load_dotenv
-from openai import OpenAI
-from pinecone import Pinecone
+from openai import AsyncOpenAI
+from pinecone.grpc import PineconeGRPC as Pinecone
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from langchain_community.document_loaders import PyPDFLoader, TextLoader
+from retry_policy import await_with_retry, call_with_retry, is_retryable_error, retry_on_transient_errors
 
 # Carica le variabili d'ambiente
 load_dotenv()
@@ -23,6 +34,9 @@ OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 PINECONE_API_KEY = os.getenv("PINECONE_API_KEY")
 PINECONE_INDEX_NAME = os.getenv("PINECONE_INDEX_NAME")
 PINECONE_ENVIRONMENT = os.getenv("PINECONE_ENVIRONMENT")
+# Libreria per il parsing dei PDF: "pypdf" (default), "pypdfium2" (più veloce)
+# o "docling" (conversione in batch di tutti i PDF, richiede `pip install docling`)
+PDF_BACKEND = os.getenv("PDF_BACKEND", "pypdf").lower()
 
 # Validazione variabili d'ambiente
 if not OPENAI_API_KEY:
@@ -31,9 +45,11 @@ if not PINECONE_API_KEY:
     raise ValueError("PINECONE_API_KEY non trovata nelle variabili d'ambiente")
 if not PINECONE_INDEX_NAME:
     raise ValueError("PINECONE_INDEX_NAME non trovata nelle variabili d'ambiente")
+if PDF_BACKEND not in ("pypdf", "pypdfium2", "docling"):
+    raise ValueError(f"PDF_BACKEND non valido: '{PDF_BACKEND}' (valori ammessi: pypdf, pypdfium2, docling)")
 
-# Inizializza i client
-openai_client = OpenAI(api_key=OPENAI_API_KEY)
+# Inizializza i client (i retry sono gestiti da retry_on_transient_errors)
+openai_client = AsyncOpenAI(api_key=OPENAI_API_KEY, max_retries=0)
 pc = Pinecone(api_key=PINECONE_API_KEY)
 
 # Configurazione per il text splitter
@@ -43,16 +59,157 @@ EMBEDDING_MODEL = "text-embedding-3-small"
 # text-embedding-3-small può essere configurato per diverse dimensioni
 # Usa 1024 per compatibilità con l'indice esistente, o cambia l'indice a 1536
 EMBEDDING_DIMENSION = 1024
-BATCH_SIZE = 50
+# Limiti di OpenAI per richiesta di embedding: 2048 testi e 300k token in totale.
+# I batch vengono chiusi al primo dei due limiti raggiunto, con margine sui token
+EMBEDDING_MAX_BATCH_SIZE = 2048
+EMBEDDING_MAX_BATCH_TOKENS = 280_000
+# Embedding e upsert girano in pipeline: ogni stadio ha la propria concorrenza
+# (il carico è dominato dalla latenza di rete verso servizi diversi).
+# Con chunk da ~250 token un batch arriva a ~1100 chunk: al massimo 5 batch
+# (2 embedder + 1 in coda + 2 upserter) tengono in memoria ~5500 embedding
+# (~180MB come liste Python), e in volo verso OpenAI ci sono al più 560k token
+EMBEDDING_CONCURRENCY = 2
+# Ogni batch di embedding diventa una decina di richieste di upsert parallele,
+# multiplexate sulla connessione gRPC
+UPSERT_CONCURRENCY = 2
+# Batch di vettori già calcolati in attesa di upsert
+PIPELINE_QUEUE_SIZE = 1
+# Documenti divisi in chunk in anticipo nei processi, mentre gli embedder lavorano
+SPLIT_PREFETCH = 4
+# Pinecone limita ogni richiesta di upsert a 2MB: con 1024 dimensioni
+# e il testo nei metadata, 100 vettori per richiesta restano sotto il limite
+UPSERT_BATCH_SIZE = 100
+# pool_threads dell'indice, mantenuto per compatibilità: con il client gRPC gli
+# upsert paralleli (async_req=True) sono future sul canale condiviso, non usano questi thread
+PINECONE_POOL_THREADS = 30
+# Id per richiesta di delete (limite di Pinecone)
+DELETE_BATCH_SIZE = 1000
+
+# Batch API di OpenAI (--batch-api): costo dimezzato, risultati entro 24 ore
+BATCH_API_COMPLETION_WINDOW = "24h"
+BATCH_API_POLL_INTERVAL = 60  # secondi tra un controllo di stato e l'altro
+BATCH_API_FINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
+# Limiti per job di embedding: 50.000 input in totale e file di input da 200MB
+# (con margine); oltre questi limiti le richieste vengono divise in più job
+BATCH_API_MAX_INPUTS = 50_000
+BATCH_API_MAX_FILE_BYTES = 190 * 1024 * 1024
+
+# Cache locale degli embedding: i chunk già visti non vengono reinviati a OpenAI
+EMBEDDING_CACHE_PATH = Path("embedding_cache.sqlite")
+# Limite prudente di parametri per singola query SQLite
+CACHE_LOOKUP_SIZE = 500
+
+# Tokenizer del modello di embedding, per dimensionare i batch
+_EMBEDDING_ENCODING = tiktoken.encoding_for_model(EMBEDDING_MODEL)
+
+# Text splitter condiviso da tutti i documenti
+_SPLITTER = RecursiveCharacterTextSplitter(
+    chunk_size=CHUNK_SIZE,
+    chunk_overlap=CHUNK_OVERLAP,
+    length_function=len,
+    separators=["\n\n", "\n", ". ", " ", ""]
+)
 
 # Percorso della cartella data
 DATA_DIR = Path("data")
 
 
+def _load_pdf(file_path: Path) -> str:
+    """
+    Estrae il testo di un PDF.
+    
+    Con PDF_BACKEND=pypdfium2 usa PDFium, molto più veloce di PyPDF;
+    se PDFium non riesce a leggere il file si ripiega su PyPDF.
+    
+    Args:
+        file_path: Percorso del file PDF
+        
+    Returns:
+        str: Testo del documento, pagine separate da una riga vuota
+    """
+    if PDF_BACKEND == "pypdfium2":
+        try:
+            import pypdfium2 as pdfium
+            
+            pdf = pdfium.PdfDocument(str(file_path))
+            try:
+                pages = [page.get_textpage().get_text_range() for page in pdf]
+            finally:
+                pdf.close()
+            # PDFium separa le righe con \r\n
+            return "\n\n".join(pages).replace("\r\n", "\n")
+        except Exception as e:
+            print(f"   [!] pypdfium2 non riesce a leggere {file_path.name} ({str(e)}), uso PyPDF")
+    
+    loaded_docs = PyPDFLoader(str(file_path)).load()
+    return "\n\n".join([doc.page_content for doc in loaded_docs])
+
+
+def _convert_pdfs_with_docling(pdf_files: List[Path]) -> Dict[Path, str]:
+    """
+    Converte tutti i PDF con Docling in un'unica chiamata convert_all,
+    così l'inizializzazione della pipeline (modelli di layout/OCR) avviene una volta sola.
+    
+    Args:
+        pdf_files: Percorsi dei file PDF
+        
+    Returns:
+        Dict[Path, str]: Testo (in Markdown) dei PDF convertiti con successo
+    """
+    try:
+        from docling.datamodel.base_models import ConversionStatus
+        from docling.document_converter import DocumentConverter
+    except ImportError:
+        raise ImportError("PDF_BACKEND=docling richiede il pacchetto docling: pip install docling")
+    
+    # Docling può restituire i percorsi in forma assoluta
+    files_by_resolved_path = {file_path.resolve(): file_path for file_path in pdf_files}
+    
+    converted = {}
+    results = DocumentConverter().convert_all(pdf_files, raises_on_error=False)
+    for result in results:
+        file_path = files_by_resolved_path.get(Path(result.input.file).resolve(), Path(result.input.file))
+        if result.status not in (ConversionStatus.SUCCESS, ConversionStatus.PARTIAL_SUCCESS):
+            print(f"   [ERRORE] Errore nel caricamento di {file_path.name}: conversione Docling {result.status.value}")
+            continue
+        converted[file_path] = result.document.export_to_markdown()
+    
+    return converted
+
+
+def _load_one(file_path: Path) -> str:
+    """
+    Carica il testo di un singolo file PDF o TXT.
+    
+    Viene eseguita in un processo separato per i PDF (parsing CPU-bound)
+    e in un thread per i TXT.
+    
+    Args:
+        file_path: Percorso del file
+        
+    Returns:
+        str: Testo completo del documento
+    """
+    if file_path.suffix.lower() == ".pdf":
+        return _load_pdf(file_path)
+    elif file_path.suffix.lower() == ".txt":
+        loader = TextLoader(str(file_path), encoding='utf-8')
+    else:
+        raise ValueError(f"Formato non supportato: {file_path.suffix}")
+    
+    loaded_docs = loader.load()
+    
+    # Unisce tutto il testo del documento
+    return "\n\n".join([doc.page_content for doc in loaded_docs])
+
+
 def load_documents() -> List[Tuple[str, str]]:
     """
     Carica tutti i file PDF e TXT dalla cartella data/.
     
+    I PDF vengono letti in parallelo su più processi (o convertiti in un unico
+    batch con PDF_BACKEND=docling), i TXT su più thread.
+    
     Returns:
         List[Tuple[str, str]]: Lista di tuple (filepath, text_content)
     """
@@ -71,32 +228,41 @@ def load_documents() -> List[Tuple[str, str]]:
     
     print(f"[+] Trovati {len(pdf_files)} file PDF e {len(txt_files)} file TXT")
     
-    for file_path in all_files:
-        try:
-            print(f"   [*] Caricamento: {file_path.name}")
-            
-            if file_path.suffix.lower() == ".pdf":
-                loader = PyPDFLoader(str(file_path))
-            elif file_path.suffix.lower() == ".txt":
-                loader = TextLoader(str(file_path), encoding='utf-8')
-            else:
-                continue
-            
-            loaded_docs = loader.load()
-            
-            # Unisce tutto il testo del documento
-            text_content = "\n\n".join([doc.page_content for doc in loaded_docs])
-            
-            if not text_content.strip():
-                print(f"   [!] File vuoto ignorato: {file_path.name}")
+    loaded = {}
+    
+    def add_document(file_path: Path, text_content: str):
+        if not text_content.strip():
+            print(f"   [!] File vuoto ignorato: {file_path.name}")
+            return
+        
+        loaded[file_path] = text_content
+        print(f"   [OK] Caricato: {file_path.name} ({len(text_content)} caratteri)")
+    
+    with ProcessPoolExecutor() as process_pool, ThreadPoolExecutor() as thread_pool:
+        futures = {thread_pool.submit(_load_one, file_path): file_path for file_path in txt_files}
+        
+        if PDF_BACKEND == "docling":
+            # Docling converte tutti i PDF in batch, mentre i TXT vengono letti nei thread
+            if pdf_files:
+                for file_path, text_content in _convert_pdfs_with_docling(pdf_files).items():
+                    add_document(file_path, text_content)
+        else:
+            futures.update({process_pool.submit(_load_one, file_path): file_path for file_path in pdf_files})
+        
+        for future in as_completed(futures):
+            file_path = futures[future]
+            try:
+                text_content = future.result()
+            except Exception as e:
+                print(f"   [ERRORE] Errore nel caricamento di {file_path.name}: {str(e)}")
                 continue
             
-            documents.append((str(file_path), text_content))
-            print(f"   [OK] Caricato: {file_path.name} ({len(text_content)} caratteri)")
-            
-        except Exception as e:
-            print(f"   [ERRORE] Errore nel caricamento di {file_path.name}: {str(e)}")
-            continue
+            add_document(file_path, text_content)
+    
+    # Mantiene l'ordine dei file indipendentemente dall'ordine di completamento
+    for file_path in all_files:
+        if file_path in loaded:
+            documents.append((str(file_path), loaded[file_path]))
     
     return documents
 
@@ -111,36 +277,363 @@ def split_text_into_chunks(text: str) -> List[str]:
     Returns:
         List[str]: Lista di chunk di testo
     """
-    text_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=CHUNK_SIZE,
-        chunk_overlap=CHUNK_OVERLAP,
-        length_function=len,
-        separators=["\n\n", "\n", ". ", " ", ""]
-    )
+    return _SPLITTER.split_text(text)
+
+
+def iter_chunks(
+    documents: List[Tuple[str, str]],
+    executor: Optional[Executor] = None,
+    show_progress: bool = True
+) -> Iterator[Tuple[str, int, str]]:
+    """
+    Genera i chunk dei documenti uno alla volta, senza tenerli tutti in memoria.
+    
+    Con un executor la divisione in chunk (CPU-bound) avviene nei suoi
+    processi, con fino a SPLIT_PREFETCH documenti elaborati in anticipo.
+    
+    Args:
+        documents: Lista di tuple (filepath, text_content)
+        executor: Executor opzionale su cui eseguire split_text_into_chunks
+        show_progress: Se False non stampa il numero di chunk di ogni documento
+        
+    Yields:
+        Tuple[str, int, str]: Tuple (filepath, chunk_index, chunk_text), nell'ordine
+        dei documenti. Il percorso usa sempre "/" così è lo stesso su ogni sistema operativo.
+    """
+    if executor is None:
+        split_documents = ((file_path, split_text_into_chunks(text)) for file_path, text in documents)
+    else:
+        split_documents = _prefetch_splits(documents, executor)
+    
+    for file_path, chunks in split_documents:
+        source = Path(file_path).as_posix()
+        if show_progress:
+            print(f"   [*] {Path(file_path).name}: {len(chunks)} chunk")
+        for chunk_index, chunk_text in enumerate(chunks):
+            yield source, chunk_index, chunk_text
+
+
+def _prefetch_splits(documents: List[Tuple[str, str]], executor: Executor) -> Iterator[Tuple[str, List[str]]]:
+    """
+    Divide i documenti sull'executor mantenendo al massimo SPLIT_PREFETCH
+    documenti in lavorazione; restituisce i risultati nell'ordine dei documenti.
+    """
+    remaining = iter(documents)
+    pending = deque()
+    while True:
+        for file_path, text in islice(remaining, SPLIT_PREFETCH - len(pending)):
+            pending.append((file_path, executor.submit(split_text_into_chunks, text)))
+        if not pending:
+            return
+        file_path, future = pending.popleft()
+        yield file_path, future.result()
+
+
+def chunk_id_prefix(source: str) -> str:
+    """
+    Prefisso comune agli id dei vettori di un file, usato per elencarli con index.list().
+    """
+    return hashlib.sha1(source.encode("utf-8")).hexdigest() + "#"
+
+
+def chunk_id(source: str, chunk_text: str) -> str:
+    """
+    Id del vettore in Pinecone, derivato da file e contenuto del chunk:
+    rieseguendo lo script i chunk invariati aggiornano gli stessi vettori
+    invece di crearne di nuovi. I vettori dei chunk modificati o rimossi
+    vengono eliminati da delete_stale_vectors().
+    """
+    return chunk_id_prefix(source) + hashlib.sha1(chunk_text.encode("utf-8")).hexdigest()
+
+
+def iter_token_bounded_batches(
+    chunks: Iterable[Tuple[str, int, str]],
+    enc: tiktoken.Encoding,
+    max_tokens: int = EMBEDDING_MAX_BATCH_TOKENS,
+    max_count: int = EMBEDDING_MAX_BATCH_SIZE
+) -> Iterator[List[Tuple[str, int, str]]]:
+    """
+    Raggruppa i chunk in batch che rispettano i limiti di una richiesta di embedding.
+    
+    Un batch viene chiuso quando il chunk successivo farebbe superare
+    `max_tokens` token oppure quando contiene già `max_count` chunk.
+    
+    Args:
+        chunks: Tuple (filepath, chunk_index, chunk_text)
+        enc: Encoding tiktoken del modello di embedding
+        max_tokens: Token massimi per batch
+        max_count: Chunk massimi per batch
+    """
+    batch = []
+    batch_tokens = 0
+    for chunk in chunks:
+        chunk_tokens = len(enc.encode_ordinary(chunk[2]))
+        if batch and (batch_tokens + chunk_tokens > max_tokens or len(batch) >= max_count):
+            yield batch
+            batch = []
+            batch_tokens = 0
+        batch.append(chunk)
+        batch_tokens += chunk_tokens
+    if batch:
+        yield batch
+
+
+_embedding_cache: Optional[sqlite3.Connection] = None
+
+
+def get_embedding_cache() -> sqlite3.Connection:
+    """
+    Apre (una sola volta) il database SQLite che fa da cache degli embedding.
+    
+    Returns:
+        sqlite3.Connection: Connessione alla cache
+    """
+    global _embedding_cache
+    if _embedding_cache is None:
+        _embedding_cache = sqlite3.connect(EMBEDDING_CACHE_PATH)
+        _embedding_cache.execute("PRAGMA journal_mode=WAL")
+        _embedding_cache.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, embedding BLOB NOT NULL)"
+        )
+    return _embedding_cache
+
+
+def embedding_cache_key(text: str) -> str:
+    """
+    Calcola la chiave di cache di un testo: cambia se cambiano testo, modello o dimensione.
+    """
+    return hashlib.sha256(f"{EMBEDDING_MODEL}|{EMBEDDING_DIMENSION}|{text}".encode("utf-8")).hexdigest()
+
+
+def get_cached_embeddings(keys: List[str]) -> Dict[str, List[float]]:
+    """
+    Recupera dalla cache gli embedding disponibili.
     
-    chunks = text_splitter.split_text(text)
-    return chunks
+    Args:
+        keys: Chiavi di cache da cercare
+        
+    Returns:
+        Dict[str, List[float]]: Embedding trovati, indicizzati per chiave
+    """
+    cache = get_embedding_cache()
+    found = {}
+    for i in range(0, len(keys), CACHE_LOOKUP_SIZE):
+        lookup = keys[i:i + CACHE_LOOKUP_SIZE]
+        placeholders = ",".join("?" * len(lookup))
+        rows = cache.execute(f"SELECT key, embedding FROM embeddings WHERE key IN ({placeholders})", lookup)
+        for key, blob in rows:
+            values = array("f")
+            values.frombytes(blob)
+            found[key] = values.tolist()
+    return found
+
+
+def store_embeddings(keys: List[str], embeddings: List[List[float]]):
+    """
+    Salva gli embedding nella cache (in float32, la stessa precisione usata da Pinecone).
+    """
+    cache = get_embedding_cache()
+    with cache:
+        cache.executemany(
+            "INSERT OR REPLACE INTO embeddings (key, embedding) VALUES (?, ?)",
+            [(key, array("f", embedding).tobytes()) for key, embedding in zip(keys, embeddings)]
+        )
 
 
-def create_embeddings(texts: List[str]) -> List[List[float]]:
+@retry_on_transient_errors
+async def _request_embeddings(texts: List[str]) -> List[List[float]]:
+    """Chiama l'endpoint embeddings di OpenAI, ripetendo la richiesta sugli errori temporanei"""
+    response = await openai_client.embeddings.create(
+        model=EMBEDDING_MODEL,
+        input=texts,
+        dimensions=EMBEDDING_DIMENSION
+    )
+    return [item.embedding for item in response.data]
+
+
+async def create_embeddings(texts: List[str]) -> List[List[float]]:
     """
     Crea gli embedding per una lista di testi usando OpenAI.
     
+    Solo i testi assenti dalla cache (e senza duplicati) vengono inviati
+    a OpenAI; il risultato mantiene l'ordine dei testi in input.
+    
     Args:
         texts: Lista di testi da convertire in embedding
         
     Returns:
         List[List[float]]: Lista di vettori embedding
     """
+    keys = [embedding_cache_key(text) for text in texts]
+    embeddings = get_cached_embeddings(keys)
+    
+    missing = {key: text for key, text in zip(keys, texts) if key not in embeddings}
+    if missing:
+        try:
+            new_embeddings = await _request_embeddings(list(missing.values()))
+        except Exception as e:
+            raise Exception(f"Errore nella creazione degli embedding: {str(e)}")
+        
+        store_embeddings(list(missing.keys()), new_embeddings)
+        embeddings.update(zip(missing.keys(), new_embeddings))
+    
+    return [embeddings[key] for key in keys]
+
+
+async def _run_batch_job(lines: List[str], job_num: int) -> str:
+    """
+    Invia un file JSONL alla Batch API e attende la fine del job (fino a 24 ore).
+    
+    Args:
+        lines: Righe JSONL, una per richiesta a /v1/embeddings
+        job_num: Numero del job, usato nei messaggi di avanzamento
+        
+    Returns:
+        str: Contenuto del file di output del job
+    """
     try:
-        response = openai_client.embeddings.create(
-            model=EMBEDDING_MODEL,
-            input=texts,
-            dimensions=EMBEDDING_DIMENSION
+        batch_input = await await_with_retry(
+            openai_client.files.create,
+            file=(f"embeddings-{job_num}.jsonl", "\n".join(lines).encode("utf-8")),
+            purpose="batch"
+        )
+        batch_job = await await_with_retry(
+            openai_client.batches.create,
+            input_file_id=batch_input.id,
+            endpoint="/v1/embeddings",
+            completion_window=BATCH_API_COMPLETION_WINDOW
         )
-        return [item.embedding for item in response.data]
+        print(f"   [*] Job Batch API {job_num} creato: {batch_job.id} ({len(lines)} richieste)")
+        
+        while batch_job.status not in BATCH_API_FINAL_STATUSES:
+            await asyncio.sleep(BATCH_API_POLL_INTERVAL)
+            batch_job = await await_with_retry(openai_client.batches.retrieve, batch_job.id)
+            counts = batch_job.request_counts
+            if counts:
+                print(f"   [*] Stato job {job_num}: {batch_job.status} ({counts.completed}/{counts.total} richieste)")
+        
+        # Un job scaduto può comunque avere completato parte delle richieste
+        if not batch_job.output_file_id:
+            raise Exception(f"job {batch_job.id} terminato con stato '{batch_job.status}' senza risultati")
+        
+        output = await await_with_retry(openai_client.files.content, batch_job.output_file_id)
+    except Exception as e:
+        raise Exception(f"Errore nella Batch API di OpenAI (job {job_num}): {str(e)}")
+    
+    return output.text
+
+
+async def create_embeddings_batch_api(batches: List[List[str]]) -> List[Optional[List[List[float]]]]:
+    """
+    Crea gli embedding di più batch tramite la Batch API di OpenAI.
+    
+    Ogni batch diventa una riga JSONL per /v1/embeddings. Le righe sono
+    divise in job che rispettano BATCH_API_MAX_INPUTS e BATCH_API_MAX_FILE_BYTES,
+    eseguiti in parallelo; i risultati sono ricomposti tramite custom_id.
+    
+    Args:
+        batches: Lista di batch di testi
+        
+    Returns:
+        List[Optional[List[List[float]]]]: Embedding per ogni batch, nello stesso
+        ordine dell'input; None per i batch falliti, anche quando fallisce
+        l'intero job che li contiene
+    """
+    jobs: List[List[str]] = []
+    job_inputs = 0
+    job_bytes = 0
+    for batch_index, texts in enumerate(batches):
+        line = json.dumps({
+            "custom_id": f"batch-{batch_index}",
+            "method": "POST",
+            "url": "/v1/embeddings",
+            "body": {
+                "model": EMBEDDING_MODEL,
+                "input": texts,
+                "dimensions": EMBEDDING_DIMENSION
+            }
+        })
+        line_bytes = len(line.encode("utf-8")) + 1
+        if not jobs or job_inputs + len(texts) > BATCH_API_MAX_INPUTS or job_bytes + line_bytes > BATCH_API_MAX_FILE_BYTES:
+            jobs.append([])
+            job_inputs = 0
+            job_bytes = 0
+        jobs[-1].append(line)
+        job_inputs += len(texts)
+        job_bytes += line_bytes
+    
+    if len(jobs) > 1:
+        print(f"   [*] Richieste divise in {len(jobs)} job Batch API")
+    
+    outputs = await asyncio.gather(
+        *[_run_batch_job(lines, job_num) for job_num, lines in enumerate(jobs, start=1)],
+        return_exceptions=True
+    )
+    
+    results: List[Optional[List[List[float]]]] = [None] * len(batches)
+    for output in outputs:
+        if isinstance(output, Exception):
+            print(f"   [ERRORE] {str(output)}")
+            continue
+        for line in output.splitlines():
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            batch_index = int(item["custom_id"].removeprefix("batch-"))
+            response = item.get("response")
+            if item.get("error") or not response or response.get("status_code") != 200:
+                print(f"   [ERRORE] Richiesta {item['custom_id']} fallita nella Batch API")
+                continue
+            data = sorted(response["body"]["data"], key=lambda d: d["index"])
+            results[batch_index] = [d["embedding"] for d in data]
+    
+    return results
+
+
+async def prefill_cache_with_batch_api(chunks: Iterable[Tuple[str, int, str]]):
+    """
+    Calcola con la Batch API gli embedding dei chunk non ancora in cache e li salva.
+    
+    I batch eventualmente falliti, o tutti se il job non parte o termina
+    senza risultati, verranno calcolati dall'endpoint sincrono durante
+    l'indicizzazione. I testi mancanti restano in memoria fino
+    all'invio, perché i file di input dei job vengono creati tutti insieme.
+    
+    Args:
+        chunks: Tuple (filepath, chunk_index, chunk_text) da indicizzare
+    """
+    # Ogni riga della Batch API ha gli stessi limiti dell'endpoint sincrono
+    seen = set()
+    key_batches = []
+    text_batches = []
+    for batch_chunks in iter_token_bounded_batches(chunks, _EMBEDDING_ENCODING):
+        keys = [embedding_cache_key(chunk_text) for _, _, chunk_text in batch_chunks]
+        cached = get_cached_embeddings(keys)
+        missing = {
+            key: chunk_text
+            for key, (_, _, chunk_text) in zip(keys, batch_chunks)
+            if key not in cached and key not in seen
+        }
+        if missing:
+            seen.update(missing)
+            key_batches.append(list(missing.keys()))
+            text_batches.append(list(missing.values()))
+    
+    if not seen:
+        print("   [OK] Tutti gli embedding sono già in cache")
+        return
+    
+    print(f"   [*] Invio di {len(seen)} chunk ({len(text_batches)} batch) alla Batch API di OpenAI...")
+    try:
+        results = await create_embeddings_batch_api(text_batches)
     except Exception as e:
-        raise Exception(f"Errore nella creazione degli embedding: {str(e)}")
+        print(f"   [ERRORE] {str(e)}")
+        print("   [!] Gli embedding mancanti verranno calcolati con l'endpoint sincrono")
+        return
+    
+    for batch_keys, embeddings in zip(key_batches, results):
+        if embeddings is not None:
+            store_embeddings(batch_keys, embeddings)
 
 
 def ensure_index_exists():
@@ -161,24 +654,236 @@ def ensure_index_exists():
         print(f"[OK] Indice '{PINECONE_INDEX_NAME}' già esistente")
 
 
-def upsert_batch(index, vectors_batch: List[dict]):
+def upsert_vectors(index, vectors: List[dict]) -> int:
+    """
+    Esegue l'upsert in parallelo di una lista di vettori in Pinecone.
+    
+    I vettori sono divisi in richieste da UPSERT_BATCH_SIZE elementi, inviate
+    tutte insieme con async_req=True come future gRPC sulla stessa connessione HTTP/2.
+    Le richieste fallite per errori temporanei vengono ripetute una alla volta.
+    
+    Args:
+        index: Indice Pinecone gRPC (creato con pool_threads)
+        vectors: Lista di dizionari con id, values e metadata
+        
+    Returns:
+        int: Numero di vettori caricati con successo
+    """
+    batches = [vectors[i:i + UPSERT_BATCH_SIZE] for i in range(0, len(vectors), UPSERT_BATCH_SIZE)]
+    async_results = [index.upsert(vectors=batch, async_req=True) for batch in batches]
+    
+    total_uploaded = 0
+    for batch_num, (batch, async_result) in enumerate(zip(batches, async_results), start=1):
+        try:
+            try:
+                async_result.result()
+            except Exception as e:
+                if not is_retryable_error(e):
+                    raise
+                call_with_retry(index.upsert, vectors=batch)
+            total_uploaded += len(batch)
+        except Exception as e:
+            print(f"   [ERRORE] Errore nell'upsert su Pinecone del batch {batch_num}: {str(e)}")
+    
+    return total_uploaded
+
+
+def delete_stale_vectors(index, current_ids: Dict[str, set]) -> int:
     """
-    Esegue l'upsert di un batch di vettori in Pinecone.
+    Elimina da Pinecone i vettori dei file reindicizzati che non corrispondono
+    più a nessun chunk (testo modificato o rimosso dal documento).
+    
+    Richiede un indice serverless: index.list() non è disponibile sugli indici pod.
     
     Args:
         index: Indice Pinecone
-        vectors_batch: Lista di dizionari con id, values e metadata
+        current_ids: Per ogni file, gli id dei chunk caricati in questa esecuzione
+        
+    Returns:
+        int: Numero di vettori eliminati
     """
-    try:
-        index.upsert(vectors=vectors_batch)
-    except Exception as e:
-        raise Exception(f"Errore nell'upsert su Pinecone: {str(e)}")
+    total_deleted = 0
+    for source, ids in current_ids.items():
+        try:
+            stale_ids = [
+                vector_id
+                for page in index.list(prefix=chunk_id_prefix(source))
+                for vector_id in page
+                if vector_id not in ids
+            ]
+            for i in range(0, len(stale_ids), DELETE_BATCH_SIZE):
+                call_with_retry(index.delete, ids=stale_ids[i:i + DELETE_BATCH_SIZE])
+        except Exception as e:
+            print(f"   [ERRORE] Errore nella rimozione dei vettori obsoleti di {source}: {str(e)}")
+            continue
+        if stale_ids:
+            print(f"   [*] {source}: rimossi {len(stale_ids)} vettori obsoleti")
+        total_deleted += len(stale_ids)
+    
+    return total_deleted
+
+
+async def index_chunks(index, documents: List[Tuple[str, str]], use_batch_api: bool = False) -> int:
+    """
+    Divide i documenti in chunk, crea gli embedding e li carica in Pinecone.
+    
+    I chunk vengono generati man mano e raggruppati in batch entro i limiti
+    di token e di testi di una richiesta di embedding,
+    quindi in memoria restano solo i batch in lavorazione. La divisione in
+    chunk gira in un pool di processi e si sovrappone alle chiamate di rete.
+    Embedding e upsert sono collegati da una coda: mentre un batch viene
+    caricato in Pinecone, gli embedder stanno già calcolando i batch successivi.
+    Con la Batch API la cache viene prima riempita con tutti gli embedding
+    mancanti, e gli embedder li leggono da lì: i documenti vengono quindi
+    divisi (e i token contati) due volte, per non tenere tutti i chunk in
+    memoria fino alla fine del job.
+    
+    Args:
+        index: Indice Pinecone (creato con pool_threads)
+        documents: Lista di tuple (filepath, text_content)
+        use_batch_api: Se True usa la Batch API di OpenAI per gli embedding
+        
+    Returns:
+        int: Numero di chunk caricati con successo
+    """
+    with ProcessPoolExecutor() as split_pool:
+        if use_batch_api:
+            await prefill_cache_with_batch_api(iter_chunks(documents, split_pool))
+        
+        # Con la Batch API il numero di chunk per documento è già stato stampato
+        chunks = iter_chunks(documents, split_pool, show_progress=not use_batch_api)
+        batches = iter_token_bounded_batches(chunks, _EMBEDDING_ENCODING)
+        return await _run_pipeline(index, batches)
+
+
+async def _run_pipeline(index, batches: Iterator[list]) -> int:
+    """
+    Esegue la pipeline divisione -> embedding -> upsert sui batch di chunk.
+    
+    Il generatore dei batch viene fatto avanzare in un thread: mentre si
+    attende la divisione dei documenti successivi l'event loop continua
+    a servire le chiamate di embedding e upsert in corso. Alla fine vengono
+    rimossi i vettori obsoleti dei file caricati senza errori.
+    
+    Args:
+        index: Indice Pinecone (creato con pool_threads)
+        batches: Batch di tuple (filepath, chunk_index, chunk_text)
+        
+    Returns:
+        int: Numero di chunk caricati con successo
+    """
+    batches_queue: asyncio.Queue = asyncio.Queue(maxsize=EMBEDDING_CONCURRENCY)
+    vectors_queue: asyncio.Queue = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    total_chunks = 0
+    total_uploaded = 0
+    # Id caricati per ogni file, e file con batch falliti (da non ripulire)
+    current_ids: Dict[str, set] = {}
+    failed_sources = set()
+    
+    async def producer():
+        nonlocal total_chunks
+        
+        batch_num = 0
+        while True:
+            batch_chunks = await asyncio.to_thread(next, batches, None)
+            if batch_chunks is None:
+                break
+            batch_num += 1
+            total_chunks += len(batch_chunks)
+            await batches_queue.put((batch_num, batch_chunks))
+        
+        # Un segnale di fine per ogni embedder
+        for _ in range(EMBEDDING_CONCURRENCY):
+            await batches_queue.put(None)
+    
+    async def embedder():
+        while True:
+            item = await batches_queue.get()
+            if item is None:
+                return
+            
+            batch_num, batch_chunks = item
+            print(f"   [*] Batch {batch_num}: processando {len(batch_chunks)} chunk...")
+            
+            try:
+                # Crea gli embedding per il batch
+                embeddings = await create_embeddings([chunk_text for _, _, chunk_text in batch_chunks])
+            except Exception as e:
+                print(f"   [ERRORE] Errore nel batch {batch_num}: {str(e)}")
+                failed_sources.update(source for source, _, _ in batch_chunks)
+                continue
+            
+            # Prepara i vettori per Pinecone; i chunk ripetuti nello stesso
+            # file hanno lo stesso id e vengono caricati una volta sola.
+            # Il file di origine nei metadata permette di filtrare le query
+            vectors_batch = {}
+            for (source, chunk_index, chunk_text), embedding in zip(batch_chunks, embeddings):
+                vector_id = chunk_id(source, chunk_text)
+                current_ids.setdefault(source, set()).add(vector_id)
+                vectors_batch[vector_id] = {
+                    "id": vector_id,
+                    "values": embedding,
+                    "metadata": {"text": chunk_text, "source": source, "chunk_index": chunk_index}
+                }
+            vectors_batch = list(vectors_batch.values())
+            
+            await vectors_queue.put((batch_num, vectors_batch))
+    
+    async def upserter():
+        nonlocal total_uploaded
+        
+        while True:
+            item = await vectors_queue.get()
+            if item is None:
+                return
+            
+            batch_num, vectors_batch = item
+            uploaded = await asyncio.to_thread(upsert_vectors, index, vectors_batch)
+            total_uploaded += uploaded
+            if uploaded < len(vectors_batch):
+                failed_sources.update(vector["metadata"]["source"] for vector in vectors_batch)
+            print(f"   [OK] Batch {batch_num} caricato: {uploaded} chunk")
+    
+    async def embedding_stage():
+        await asyncio.gather(producer(), *[embedder() for _ in range(EMBEDDING_CONCURRENCY)])
+        # Un segnale di fine per ogni upserter
+        for _ in range(UPSERT_CONCURRENCY):
+            await vectors_queue.put(None)
+    
+    await asyncio.gather(embedding_stage(), *[upserter() for _ in range(UPSERT_CONCURRENCY)])
+    
+    # Un file con batch falliti mantiene i vecchi vettori, per non perdere chunk
+    for source in failed_sources:
+        current_ids.pop(source, None)
+    await asyncio.to_thread(delete_stale_vectors, index, current_ids)
+    
+    if not total_chunks:
+        print("\n[!] Nessun chunk generato dai documenti.")
+    else:
+        print(f"\n[OK] Totale chunk generati: {total_chunks}")
+    
+    return total_uploaded
+
+
+def parse_args() -> argparse.Namespace:
+    """
+    Legge le opzioni da riga di comando.
+    """
+    parser = argparse.ArgumentParser(description="Carica i documenti di data/ in Pinecone.")
+    parser.add_argument(
+        "--batch-api",
+        action="store_true",
+        help="Usa la Batch API di OpenAI per gli embedding (costo dimezzato, completamento fino a 24 ore)"
+    )
+    return parser.parse_args()
 
 
 def main():
     """
     Funzione principale che orchetra il processo di indicizzazione.
     """
+    args = parse_args()
+    
     print("[*] Caricamento documenti in Pinecone...\n")
     
     try:
@@ -192,61 +897,16 @@ def main():
             print("\n[!] Nessun documento da processare.")
             return
         
-        # 3. Divide in chunk
-        print(f"\n[*] Divisione dei documenti in chunk...")
-        all_chunks = []
-        for file_path, text in documents:
-            chunks = split_text_into_chunks(text)
-            all_chunks.extend(chunks)
-            print(f"   [*] {Path(file_path).name}: {len(chunks)} chunk")
-        
-        if not all_chunks:
-            print("\n[!] Nessun chunk generato dai documenti.")
-            return
-        
-        print(f"\n[OK] Totale chunk generati: {len(all_chunks)}")
-        
-        # 4. Recupera l'indice Pinecone
-        index = pc.Index(PINECONE_INDEX_NAME)
-        
-        # 5. Processa i chunk in batch
-        print(f"\n[>] Creazione embedding e caricamento in Pinecone...")
-        
-        total_uploaded = 0
-        chunk_id_counter = 1
-        
-        for i in range(0, len(all_chunks), BATCH_SIZE):
-            batch_chunks = all_chunks[i:i + BATCH_SIZE]
-            batch_num = (i // BATCH_SIZE) + 1
-            total_batches = (len(all_chunks) + BATCH_SIZE - 1) // BATCH_SIZE
+        # 3. Recupera l'indice Pinecone
+        with pc.Index(PINECONE_INDEX_NAME, pool_threads=PINECONE_POOL_THREADS) as index:
+            stats = call_with_retry(index.describe_index_stats)
+            print(f"[OK] Connesso all'indice '{PINECONE_INDEX_NAME}' via gRPC ({stats.total_vector_count} vettori presenti)")
             
-            print(f"   [*] Batch {batch_num}/{total_batches}: processando {len(batch_chunks)} chunk...")
-            
-            try:
-                # Crea gli embedding per il batch
-                embeddings = create_embeddings(batch_chunks)
-                
-                # Prepara i vettori per Pinecone
-                vectors_batch = []
-                for chunk_text, embedding in zip(batch_chunks, embeddings):
-                    vectors_batch.append({
-                        "id": f"id-{chunk_id_counter}",
-                        "values": embedding,
-                        "metadata": {"text": chunk_text}
-                    })
-                    chunk_id_counter += 1
-                
-                # Esegue l'upsert
-                upsert_batch(index, vectors_batch)
-                total_uploaded += len(vectors_batch)
-                
-                print(f"   [OK] Batch {batch_num} caricato: {len(vectors_batch)} chunk")
-                
-            except Exception as e:
-                print(f"   [ERRORE] Errore nel batch {batch_num}: {str(e)}")
-                continue
+            # 4. Divide in chunk, crea gli embedding e carica i vettori in pipeline
+            print(f"\n[>] Divisione in chunk, creazione embedding e caricamento in Pinecone...")
+            total_uploaded = asyncio.run(index_chunks(index, documents, use_batch_api=args.batch_api))
         
-        # 6. Output finale
+        # 5. Output finale
         print(f"\n[*] Caricati {total_uploaded} chunk in totale.")
         print("[OK] Operazione completata: Knowledge base aggiornata!")
         
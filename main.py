@@ -1,20 +1,45 @@
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel, Field
-from typing import Optional
+from typing import List, Optional, Tuple
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+import asyncio
+import hashlib
+import json
 import os
+import numpy as np
+import tiktoken
 from dotenv import load_dotenv
-from openai import OpenAI
-from pinecone import Pinecone
+from openai import AsyncOpenAI
+from pinecone.grpc import PineconeGRPC as Pinecone
+from retry_policy import await_with_retry, call_with_retry
 
 # Carica le variabili d'ambiente
 load_dotenv()
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Recupera l'indice Pinecone all'avvio e lo riusa per tutte le richieste:
+    pc.Index(nome) interroga Pinecone per l'host dell'indice, una chiamata
+    di rete da non ripetere ad ogni domanda. Il client gRPC mantiene aperta
+    una connessione HTTP/2, verificata subito con describe_index_stats().
+    """
+    index = await asyncio.to_thread(get_pinecone_index)
+    await asyncio.to_thread(call_with_retry, index.describe_index_stats)
+    app.state.index = index
+    yield
+    index.close()
+
+
 # Inizializza FastAPI
 app = FastAPI(
     title="longevity Backend",
     description="Backend API per consulenze nutrizionali basate su AI",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
 # Configurazione CORS
@@ -31,19 +56,30 @@ openai_api_key = os.getenv("OPENAI_API_KEY")
 if not openai_api_key:
     raise ValueError("OPENAI_API_KEY non trovata nelle variabili d'ambiente")
 
-# Inizializza il client OpenAI
-openai_client = OpenAI(api_key=openai_api_key)
+# Inizializza il client OpenAI (asincrono, per non bloccare l'event loop);
+# i retry sono gestiti da retry_policy
+openai_client = AsyncOpenAI(api_key=openai_api_key, max_retries=0)
 
 # Configurazione Pinecone
 pinecone_api_key = os.getenv("PINECONE_API_KEY")
 pinecone_index_name = os.getenv("PINECONE_INDEX_NAME")
+# Opzionale: con l'host dell'indice noto non serve interrogare Pinecone all'avvio
+pinecone_index_host = os.getenv("PINECONE_INDEX_HOST")
 
 if not pinecone_api_key or not pinecone_index_name:
     raise ValueError("Variabili d'ambiente Pinecone mancanti")
 
-# Inizializza Pinecone
+# Inizializza Pinecone (client gRPC)
 pc = Pinecone(api_key=pinecone_api_key)
 
+
+def get_pinecone_index():
+    """Crea l'handle dell'indice Pinecone, usando l'host configurato se presente"""
+    if pinecone_index_host:
+        return pc.Index(host=pinecone_index_host)
+    return pc.Index(pinecone_index_name)
+
+
 # Modelli Pydantic per la validazione
 class UserData(BaseModel):
     age: Optional[int] = Field(None, ge=0, le=150, description="Età dell'utente")
@@ -58,88 +94,144 @@ class UserData(BaseModel):
 class AskRequest(BaseModel):
     question: str = Field(..., min_length=1, description="Domanda dell'utente")
     user_data: Optional[UserData] = Field(None, description="Dati biometrici dell'utente")
+    sources: Optional[List[str]] = Field(None, min_length=1, description="Limita la ricerca a questi documenti (es. data/omega3.pdf)")
 
 
 class AskResponse(BaseModel):
     answer: str = Field(..., description="Risposta generata da GPT-4")
 
 
+# Limiti di token del contesto passato a GPT-4: ogni documento viene troncato
+# a MAX_DOCUMENT_TOKENS e si aggiungono documenti finché il totale resta entro MAX_CONTEXT_TOKENS
+MAX_CONTEXT_TOKENS = 2000
+MAX_DOCUMENT_TOKENS = 1000
+context_encoding = tiktoken.encoding_for_model("gpt-4o-mini")
+
+
+def fit_context_to_budget(context_documents: List[str]) -> List[str]:
+    """
+    Tronca i documenti di contesto per rispettare i limiti di token.
+    
+    I documenti arrivano in ordine di rilevanza: quelli che non entrano
+    nel budget residuo vengono scartati. Se tutti entrano, non cambia nulla.
+    """
+    fitted_documents = []
+    used_tokens = 0
+    for document in context_documents:
+        tokens = context_encoding.encode_ordinary(document)
+        if len(tokens) > MAX_DOCUMENT_TOKENS:
+            tokens = tokens[:MAX_DOCUMENT_TOKENS]
+            document = context_encoding.decode(tokens)
+        if used_tokens + len(tokens) > MAX_CONTEXT_TOKENS:
+            break
+        fitted_documents.append(document)
+        used_tokens += len(tokens)
+    return fitted_documents
+
+
+# Cache delle risposte: una domanda identica (o molto simile) non richiede
+# di nuovo embedding, query su Pinecone e generazione
+QUERY_CACHE_SIZE = 1000
+# Similarità coseno minima perché una domanda precedente sia considerata equivalente
+SEMANTIC_CACHE_THRESHOLD = 0.95
+EMBEDDING_DIMENSION = 1024
+
+# Cache esatta: hash della richiesta completa -> risposta
+answer_cache: "OrderedDict[str, str]" = OrderedDict()
+# Cache semantica: embedding normalizzati delle domande precedenti (buffer circolare)
+semantic_cache_vectors = np.zeros((QUERY_CACHE_SIZE, EMBEDDING_DIMENSION), dtype=np.float32)
+semantic_cache_answers: List[Optional[str]] = [None] * QUERY_CACHE_SIZE
+semantic_cache_next = 0
+
+
+def get_request_cache_key(request: AskRequest) -> str:
+    """Hash della richiesta completa (domanda, dati biometrici e documenti)"""
+    return hashlib.sha256(request.model_dump_json().encode("utf-8")).hexdigest()
+
+
+def uses_semantic_cache(request: AskRequest) -> bool:
+    """
+    La cache semantica è usata solo per domande senza dati biometrici né filtri
+    sui documenti: in quei casi la risposta non dipende solo dalla domanda.
+    """
+    return request.user_data is None and request.sources is None
+
+
+def get_exact_cached_answer(cache_key: str) -> Optional[str]:
+    """Restituisce la risposta salvata per una richiesta identica, se presente"""
+    answer = answer_cache.get(cache_key)
+    if answer is not None:
+        answer_cache.move_to_end(cache_key)
+    return answer
+
+
+def get_semantic_cached_answer(query_vector: List[float]) -> Optional[str]:
+    """Restituisce la risposta di una domanda precedente abbastanza simile, se presente"""
+    vector = np.asarray(query_vector, dtype=np.float32)
+    vector /= np.linalg.norm(vector)
+    similarities = semantic_cache_vectors @ vector
+    best = int(np.argmax(similarities))
+    if similarities[best] >= SEMANTIC_CACHE_THRESHOLD:
+        return semantic_cache_answers[best]
+    return None
+
+
+def store_cached_answer(cache_key: str, query_vector: Optional[List[float]], answer: str):
+    """Salva la risposta nella cache esatta e, se c'è l'embedding, in quella semantica"""
+    global semantic_cache_next
+    
+    answer_cache[cache_key] = answer
+    answer_cache.move_to_end(cache_key)
+    if len(answer_cache) > QUERY_CACHE_SIZE:
+        answer_cache.popitem(last=False)
+    
+    if query_vector is not None:
+        vector = np.asarray(query_vector, dtype=np.float32)
+        semantic_cache_vectors[semantic_cache_next] = vector / np.linalg.norm(vector)
+        semantic_cache_answers[semantic_cache_next] = answer
+        semantic_cache_next = (semantic_cache_next + 1) % QUERY_CACHE_SIZE
+
+
 @app.get("/")
 async def root():
     """Endpoint di health check"""
     return {"status": "ok", "message": "longevity Backend è attivo"}
 
 
-@app.post("/ask", response_model=AskResponse)
-async def ask_question(request: AskRequest):
+async def get_cached_answer(request: AskRequest, cache_key: str) -> Tuple[Optional[str], Optional[List[float]]]:
     """
-    Endpoint principale per fare domande nutrizionali.
+    Cerca una risposta già generata per la richiesta.
     
-    Riceve una domanda e opzionalmente dati biometrici,
-    interroga Pinecone per documenti rilevanti,
-    e genera una risposta usando GPT-4.
+    Returns:
+        Tuple[Optional[str], Optional[List[float]]]: (risposta in cache, embedding della domanda).
+        L'embedding è calcolato solo se la richiesta non è nella cache esatta.
     """
-    try:
-        # Recupera l'indice Pinecone
-        index = pc.Index(pinecone_index_name)
-        
-        # Crea l'embedding della domanda usando OpenAI
-        # Usa text-embedding-3-small con dimensions=1024 per compatibilità con l'indice Pinecone
-        embedding_response = openai_client.embeddings.create(
-            model="text-embedding-3-small",
-            input=request.question,
-            dimensions=1024
-        )
-        query_vector = embedding_response.data[0].embedding
-        
-        # Query su Pinecone per recuperare i top 3 documenti più rilevanti
-        query_results = index.query(
-            vector=query_vector,
-            top_k=3,
-            include_metadata=True
-        )
-        
-        # Estrae i testi dai documenti recuperati
-        context_documents = []
-        for match in query_results.matches:
-            if match.metadata and 'text' in match.metadata:
-                context_documents.append(match.metadata['text'])
-            elif 'content' in match.metadata:
-                context_documents.append(match.metadata['content'])
-        
-        if not context_documents:
-            raise HTTPException(
-                status_code=404,
-                detail="Nessun documento rilevante trovato in Pinecone"
-            )
-        
-        # Costruisce il contesto per GPT-4
-        context = "\n\n".join(context_documents)
-        
-        # Prepara il prompt con i dati biometrici se presenti
-        user_context = ""
-        if request.user_data:
-            user_parts = []
-            if request.user_data.age:
-                user_parts.append(f"Età: {request.user_data.age} anni")
-            if request.user_data.weight:
-                user_parts.append(f"Peso: {request.user_data.weight} kg")
-            if request.user_data.height:
-                user_parts.append(f"Altezza: {request.user_data.height} cm")
-            if request.user_data.gender:
-                user_parts.append(f"Genere: {request.user_data.gender}")
-            if request.user_data.activity_level:
-                user_parts.append(f"Livello di attività: {request.user_data.activity_level}")
-            if request.user_data.goal:
-                user_parts.append(f"Obiettivo: {request.user_data.goal}")
-            if request.user_data.dietary_preferences:
-                user_parts.append(f"Preferenze alimentari/allergie: {request.user_data.dietary_preferences}")
-            
-            if user_parts:
-                user_context = f"\n\nDati biometrici dell'utente:\n" + "\n".join(user_parts)
-        
-        # Costruisce il messaggio di sistema e la domanda
-        system_message = """Sei un’assistente nutrizionista professionale, empatica e competente.  
+    # Risposta già generata per una richiesta identica
+    cached_answer = get_exact_cached_answer(cache_key)
+    if cached_answer is not None:
+        return cached_answer, None
+    
+    # Crea l'embedding della domanda usando OpenAI
+    # Usa text-embedding-3-small con dimensions=1024 per compatibilità con l'indice Pinecone
+    embedding_response = await await_with_retry(
+        openai_client.embeddings.create,
+        model="text-embedding-3-small",
+        input=request.question,
+        dimensions=EMBEDDING_DIMENSION
+    )
+    query_vector = embedding_response.data[0].embedding
+    
+    # Risposta già generata per una domanda molto simile
+    if uses_semantic_cache(request):
+        cached_answer = get_semantic_cached_answer(query_vector)
+        if cached_answer is not None:
+            store_cached_answer(cache_key, None, cached_answer)
+    
+    return cached_answer, query_vector
+
+
+# Messaggio di sistema per GPT-4, uguale per tutte le richieste
+SYSTEM_MESSAGE = """Sei un’assistente nutrizionista professionale, empatica e competente.  
 Il tuo obiettivo è aiutare l’utente a migliorare la propria alimentazione in modo scientifico e personalizzato.  
 
 COMPORTAMENTO GENERALE:
@@ -176,40 +268,194 @@ In sintesi:
 Comportati come una vera nutrizionista basata su evidenze scientifiche, capace di fare domande mirate, di essere concisa o dettagliata a seconda del caso, e di rispondere solo se le informazioni del contesto lo consentono.
 """
 
-        user_message = f"""Contesto scientifico (fonte: database Pinecone):
+# Righe dei dati biometrici nel prompt, nell'ordine in cui compaiono
+USER_PARTS_TEMPLATE = {
+    "age": "Età: {} anni",
+    "weight": "Peso: {} kg",
+    "height": "Altezza: {} cm",
+    "gender": "Genere: {}",
+    "activity_level": "Livello di attività: {}",
+    "goal": "Obiettivo: {}",
+    "dietary_preferences": "Preferenze alimentari/allergie: {}",
+}
 
-{context}
-{user_context}
 
-Domanda dell'utente: {request.question}
+async def build_chat_messages(request: AskRequest, query_vector: List[float]) -> List[dict]:
+    """
+    Recupera da Pinecone i documenti rilevanti e costruisce i messaggi per GPT-4.
+    """
+    # Filtra lato Pinecone sui documenti richiesti, se indicati
+    query_filter = {"source": {"$in": request.sources}} if request.sources else None
+    
+    # Query su Pinecone per recuperare i top 3 documenti più rilevanti
+    # (il client Pinecone è sincrono: la query gira in un thread separato)
+    query_results = await asyncio.to_thread(
+        call_with_retry,
+        app.state.index.query,
+        vector=query_vector,
+        top_k=3,
+        filter=query_filter,
+        include_metadata=True
+    )
+    
+    # Estrae i testi dai documenti recuperati
+    context_documents = []
+    for match in query_results.matches:
+        if match.metadata and 'text' in match.metadata:
+            context_documents.append(match.metadata['text'])
+        elif 'content' in match.metadata:
+            context_documents.append(match.metadata['content'])
+    
+    if not context_documents:
+        raise HTTPException(
+            status_code=404,
+            detail="Nessun documento rilevante trovato in Pinecone"
+        )
+    
+    # Costruisce il contesto per GPT-4, entro il budget di token
+    context = "\n\n".join(fit_context_to_budget(context_documents))
+    
+    # Prepara il prompt con i dati biometrici se presenti
+    user_context = ""
+    if request.user_data:
+        user_parts = [
+            template.format(value)
+            for field, template in USER_PARTS_TEMPLATE.items()
+            if (value := getattr(request.user_data, field))
+        ]
+        
+        if user_parts:
+            user_context = f"\n\nDati biometrici dell'utente:\n" + "\n".join(user_parts)
+    
+    # Costruisce la domanda per GPT-4
+    user_message = "\n".join([
+        "Contesto scientifico (fonte: database Pinecone):",
+        "",
+        context,
+        user_context,
+        "",
+        f"Domanda dell'utente: {request.question}",
+        "",
+        "Fornisci una risposta dettagliata basata esclusivamente sulle informazioni fornite nel contesto sopra."
+    ])
+    
+    return [
+        {"role": "system", "content": SYSTEM_MESSAGE},
+        {"role": "user", "content": user_message}
+    ]
+
+
+def to_http_exception(e: Exception) -> HTTPException:
+    """Converte un errore in una risposta HTTP"""
+    # Gestisce errori specifici di OpenAI se presenti
+    if hasattr(e, 'status_code'):
+        status_code = getattr(e, 'status_code', 500)
+        return HTTPException(
+            status_code=status_code,
+            detail=f"Errore API OpenAI: {str(e)}"
+        )
+    # Gestisce tutti gli altri errori
+    return HTTPException(
+        status_code=500,
+        detail=f"Errore interno del server: {str(e)}"
+    )
 
-Fornisci una risposta dettagliata basata esclusivamente sulle informazioni fornite nel contesto sopra."""
 
+def format_sse(data: dict) -> str:
+    """Formatta un evento Server-Sent Events (il testo è in JSON per preservare gli a capo)"""
+    return f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+@app.post("/ask", response_model=AskResponse)
+async def ask_question(request: AskRequest):
+    """
+    Endpoint principale per fare domande nutrizionali.
+    
+    Riceve una domanda e opzionalmente dati biometrici,
+    interroga Pinecone per documenti rilevanti,
+    e genera una risposta usando GPT-4.
+    """
+    try:
+        cache_key = get_request_cache_key(request)
+        cached_answer, query_vector = await get_cached_answer(request, cache_key)
+        if cached_answer is not None:
+            return AskResponse(answer=cached_answer)
+        
+        messages = await build_chat_messages(request, query_vector)
+        
         # Chiama GPT-4 per generare la risposta
-        completion = openai_client.chat.completions.create(
+        completion = await await_with_retry(
+            openai_client.chat.completions.create,
             model="gpt-4o-mini",
-            messages=[
-                {"role": "system", "content": system_message},
-                {"role": "user", "content": user_message}
-            ],
+            messages=messages,
             temperature=0.7,
             max_tokens=1000
         )
         
         answer = completion.choices[0].message.content
         
+        if answer:
+            semantic_vector = query_vector if uses_semantic_cache(request) else None
+            store_cached_answer(cache_key, semantic_vector, answer)
+        
         return AskResponse(answer=answer)
     
     except Exception as e:
-        # Gestisce errori specifici di OpenAI se presenti
-        if hasattr(e, 'status_code'):
-            status_code = getattr(e, 'status_code', 500)
-            raise HTTPException(
-                status_code=status_code,
-                detail=f"Errore API OpenAI: {str(e)}"
+        raise to_http_exception(e)
+
+
+@app.post("/ask/stream")
+async def ask_question_stream(request: AskRequest):
+    """
+    Come /ask, ma invia la risposta man mano che viene generata (Server-Sent Events).
+    
+    Ogni evento contiene {"content": "..."} con il testo successivo;
+    lo stream termina con "data: [DONE]". In caso di errore durante la
+    generazione viene inviato un evento {"error": "..."}.
+    """
+    try:
+        cache_key = get_request_cache_key(request)
+        cached_answer, query_vector = await get_cached_answer(request, cache_key)
+        
+        if cached_answer is None:
+            messages = await build_chat_messages(request, query_vector)
+            
+            # Chiama GPT-4 in modalità streaming
+            completion = await await_with_retry(
+                openai_client.chat.completions.create,
+                model="gpt-4o-mini",
+                messages=messages,
+                temperature=0.7,
+                max_tokens=1000,
+                stream=True
             )
-        # Gestisce tutti gli altri errori
-        raise HTTPException(
-            status_code=500,
-            detail=f"Errore interno del server: {str(e)}"
-        )
\ No newline at end of file
+    except Exception as e:
+        raise to_http_exception(e)
+    
+    async def event_stream():
+        if cached_answer is not None:
+            yield format_sse({"content": cached_answer})
+            yield "data: [DONE]\n\n"
+            return
+        
+        answer_parts = []
+        try:
+            async for chunk in completion:
+                if not chunk.choices:
+                    continue
+                content = chunk.choices[0].delta.content
+                if content:
+                    answer_parts.append(content)
+                    yield format_sse({"content": content})
+        except Exception as e:
+            yield format_sse({"error": f"Errore durante la generazione: {str(e)}"})
+            return
+        
+        answer = "".join(answer_parts)
+        if answer:
+            semantic_vector = query_vector if uses_semantic_cache(request) else None
+            store_cached_answer(cache_key, semantic_vector, answer)
+        
+        yield "data: [DONE]\n\n"
+    
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
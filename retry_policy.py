@@ -0,0 +1,99 @@
+"""
+Politica di retry condivisa per le chiamate a OpenAI e Pinecone.
+
+Le chiamate fallite per rate limit (429), errori temporanei del server (5xx)
+o problemi di connessione vengono ripetute con backoff esponenziale e jitter,
+rispettando l'header Retry-After quando il servizio lo invia.
+"""
+
+from typing import Optional
+
+import grpc
+import openai
+from pinecone.exceptions import PineconeApiException, PineconeException
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_random_exponential
+
+MAX_ATTEMPTS = 6
+MIN_WAIT = 1  # secondi
+MAX_WAIT = 60  # secondi
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+RETRYABLE_GRPC_STATUS_CODES = {
+    grpc.StatusCode.UNAVAILABLE,
+    grpc.StatusCode.RESOURCE_EXHAUSTED,
+    grpc.StatusCode.DEADLINE_EXCEEDED,
+    grpc.StatusCode.ABORTED,
+}
+
+_exponential_wait = wait_random_exponential(min=MIN_WAIT, max=MAX_WAIT)
+
+
+def is_retryable_error(e: BaseException) -> bool:
+    """Indica se l'errore è temporaneo e la chiamata può essere ripetuta"""
+    # APITimeoutError è una sottoclasse di APIConnectionError
+    if isinstance(e, (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError)):
+        return True
+    if isinstance(e, PineconeApiException):
+        return e.status in RETRYABLE_STATUS_CODES
+    # Il client gRPC avvolge l'RpcError originale in una PineconeException
+    if isinstance(e, PineconeException) and isinstance(e.__cause__, grpc.RpcError):
+        try:
+            return e.__cause__.code() in RETRYABLE_GRPC_STATUS_CODES
+        except Exception:
+            return False
+    return False
+
+
+def _get_retry_after(e: BaseException) -> Optional[float]:
+    """Legge l'header Retry-After (in secondi) dalla risposta di errore, se presente"""
+    if isinstance(e, openai.APIStatusError):
+        headers = e.response.headers
+    else:
+        headers = getattr(e, "headers", None)
+    if not headers:
+        return None
+
+    retry_after_ms = headers.get("retry-after-ms")
+    if retry_after_ms:
+        try:
+            return float(retry_after_ms) / 1000
+        except ValueError:
+            pass
+
+    retry_after = headers.get("retry-after")
+    if retry_after:
+        try:
+            return float(retry_after)
+        except ValueError:
+            # Formato data HTTP: si usa il backoff esponenziale
+            pass
+    return None
+
+
+def _wait_retry_after_or_exponential(retry_state) -> float:
+    """Attende quanto indicato da Retry-After, altrimenti backoff esponenziale con jitter"""
+    retry_after = _get_retry_after(retry_state.outcome.exception())
+    if retry_after is not None:
+        return min(max(retry_after, 0), MAX_WAIT)
+    return _exponential_wait(retry_state)
+
+
+# Decoratore per funzioni sincrone e asincrone; dopo l'ultimo tentativo
+# viene rilanciata l'eccezione originale
+retry_on_transient_errors = retry(
+    retry=retry_if_exception(is_retryable_error),
+    wait=_wait_retry_after_or_exponential,
+    stop=stop_after_attempt(MAX_ATTEMPTS),
+    reraise=True
+)
+
+
+@retry_on_transient_errors
+async def await_with_retry(func, *args, **kwargs):
+    """Esegue `await func(*args, **kwargs)` con la politica di retry"""
+    return await func(*args, **kwargs)
+
+
+@retry_on_transient_errors
+def call_with_retry(func, *args, **kwargs):
+    """Esegue `func(*args, **kwargs)` con la politica di retry"""
+    return func(*args, **kwargs)
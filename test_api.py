@@ -87,6 +87,46 @@ def test_ask_simple():
         print(f"❌ Errore: {e}")
         return False
 
+def test_ask_stream():
+    """Testa l'endpoint /ask/stream (Server-Sent Events)"""
+    print("\n🧪 Test Endpoint /ask/stream...")
+    
+    payload = {
+        "question": "Quali sono i benefici degli omega-3?"
+    }
+    
+    try:
+        response = requests.post(
+            f"{BASE_URL}/ask/stream",
+            json=payload,
+            headers={"Content-Type": "application/json"},
+            stream=True
+        )
+        print(f"✅ Status Code: {response.status_code}")
+        
+        if response.status_code != 200:
+            print(f"❌ Errore: {response.text}")
+            return False
+        
+        print("✅ Risposta ricevuta:")
+        for line in response.iter_lines(decode_unicode=True):
+            if not line or not line.startswith("data: "):
+                continue
+            data = line[len("data: "):]
+            if data == "[DONE]":
+                break
+            event = json.loads(data)
+            if "error" in event:
+                print(f"\n❌ Errore: {event['error']}")
+                return False
+            print(event["content"], end="", flush=True)
+        print()
+        
+        return True
+    except Exception as e:
+        print(f"❌ Errore: {e}")
+        return False
+
 if __name__ == "__main__":
     print("=" * 50)
     print("🚀 Test API wellneAi Backend")
@@ -99,6 +139,7 @@ if __name__ == "__main__":
         # Test endpoint /ask
         test_ask_endpoint()
         test_ask_simple()
+        test_ask_stream()
     else:
         print("\n❌ Il server non risponde. Assicurati che sia avviato!")
         print("   Avvia il server con: python -m uvicorn main:app --reload")